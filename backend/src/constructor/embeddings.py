@@ -0,0 +1,213 @@
+from typing import List, Optional, Dict
+from abc import abstractmethod
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+from transformers import AutoConfig, AutoTokenizer
+from transformers.utils import cached_file
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from .torch_utils import optimize_for_inference, select_device, ipex
+from .tokenizer_cache import get_tokenizer, share_tokenizer
+import numpy as np
+import sqlite3
+import torch
+import json
+import os
+
+
+def _encoder_max_length(model_name: str, tokenizer) -> int:
+    # the limit sentence-transformers truncates at, so both backends embed the same input length
+    config_path = cached_file(model_name, 'sentence_bert_config.json', _raise_exceptions_for_missing_entries=False)
+    if config_path:
+        with open(config_path) as f:
+            max_seq_length = json.load(f).get('max_seq_length')
+        if max_seq_length:
+            return max_seq_length
+
+    # model_max_length falls back to a huge sentinel when the tokenizer config does not set it
+    return min(tokenizer.model_max_length, AutoConfig.from_pretrained(model_name).max_position_embeddings)
+
+
+class EncoderEmbeddings(Embeddings):
+    @abstractmethod
+    def encode(self, texts: List[str]) -> np.ndarray:
+        ...
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+class SentenceTransformerEmbeddings(EncoderEmbeddings):
+    def __init__(
+        self,
+        model_name: str,
+        max_seq_length: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        compile_model: bool = False
+    ):
+        self.model_name = model_name
+        self.device = select_device()
+        self.batch_size = batch_size or (128 if self.device == 'cuda' else 32)
+        self.model = SentenceTransformer(
+            model_name,
+            device=self.device,
+            model_kwargs={'torch_dtype': torch.float16} if self.device == 'cuda' else None
+        )
+        # reuse the LLM's tokenizer when both come from the same vocabulary family
+        self.model.tokenizer = share_tokenizer(self.model.tokenizer)
+
+        # chunk_size is measured in characters, so it is an upper bound on the chunk length in tokens
+        if max_seq_length:
+            self.model.max_seq_length = min(self.model.max_seq_length or max_seq_length, max_seq_length)
+
+        self.autocast_bf16 = compile_model and self.device == 'cpu' and ipex is not None
+        if compile_model:
+            transformer = self.model[0]
+            transformer.auto_model = optimize_for_inference(
+                transformer.auto_model,
+                self.device,
+                dtype=torch.bfloat16 if self.autocast_bf16 else None
+            )
+            self.encode(['warmup ' * self.model.max_seq_length] * self.batch_size)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        # encode() sorts texts by length so every batch is padded only to its own longest text
+        with torch.autocast(device_type=self.device, dtype=torch.bfloat16, enabled=self.autocast_bf16):
+            embeddings = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+                convert_to_tensor=True,
+                normalize_embeddings=True
+            )
+        return embeddings.float().cpu().numpy()
+
+
+class OnnxInt8Embeddings(EncoderEmbeddings):
+    def __init__(
+        self,
+        model_name: str,
+        max_seq_length: Optional[int] = None,
+        batch_size: int = 32,
+        save_dir: str = 'onnx_models'
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.save_dir = os.path.join(save_dir, model_name.replace('/', '__'))
+        quantized_file = 'model_quantized.onnx'
+
+        if not os.path.exists(os.path.join(self.save_dir, quantized_file)):
+            print(f'Exporting {model_name} to ONNX and quantizing to int8 in {self.save_dir}')
+            model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(
+                save_dir=self.save_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+            )
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(self.save_dir)
+
+        self.model = ORTModelForFeatureExtraction.from_pretrained(self.save_dir, file_name=quantized_file)
+        self.tokenizer = get_tokenizer(self.save_dir)
+        model_max_length = _encoder_max_length(model_name, self.tokenizer)
+        self.max_seq_length = min(model_max_length, max_seq_length or model_max_length)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        embeddings = None
+
+        for start in range(0, len(texts), self.batch_size):
+            batch_ids = order[start:start + self.batch_size]
+            inputs = self.tokenizer(
+                [texts[i] for i in batch_ids],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors='np'
+            )
+            hidden = self.model(**inputs).last_hidden_state
+
+            mask = inputs['attention_mask'][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+            if embeddings is None:
+                embeddings = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            embeddings[batch_ids] = pooled
+
+        return embeddings
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.vectors_path = os.path.join(cache_dir, 'vectors.f32')
+        # autocommit mode, so put() can open its own BEGIN IMMEDIATE transaction
+        self.db = sqlite3.connect(
+            os.path.join(cache_dir, 'index.sqlite'),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _meta(self, key: str) -> Optional[int]:
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _rows(self) -> int:
+        rows = self._meta('rows')
+        if rows is None:
+            # caches written before the row count was tracked
+            rows = self.db.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings').fetchone()[0]
+        return rows
+
+    def get(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        rows = {}
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), 500):
+            batch = unique_keys[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            rows.update(self.db.execute(
+                f'SELECT hash, row FROM embeddings WHERE hash IN ({placeholders})', batch
+            ).fetchall())
+
+        if not rows:
+            return {}
+
+        # read after the lookup, so every row found above is covered even if another writer commits in between;
+        # bytes past the committed rows (a torn append) are never mapped
+        vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._rows(), self._meta('dim')))
+        return {key: np.array(vectors[row]) for key, row in rows.items()}
+
+    def put(self, keys: List[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        # the write lock is held from picking the first row until the rows are committed, so concurrent writers
+        # never get the same rows
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            dim = self._meta('dim')
+            if dim is None:
+                dim = vectors.shape[1]
+                self.db.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (dim,))
+            start = self._rows()
+
+            with open(self.vectors_path, 'ab') as f:
+                # drops whatever an interrupted append left past the last committed row
+                f.truncate(start * dim * vectors.itemsize)
+                f.write(vectors.tobytes())
+
+            self.db.executemany(
+                'INSERT OR IGNORE INTO embeddings (hash, row) VALUES (?, ?)',
+                [(key, start + i) for i, key in enumerate(keys)]
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('rows', ?)", (start + len(vectors),)
+            )
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
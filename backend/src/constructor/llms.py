@@ -0,0 +1,83 @@
+from typing import Any, List, Optional
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, LLMResult
+from langchain_community.llms.utils import enforce_stop_tokens
+import torch
+
+
+PREFIX_PROBE = ' \n            Пример контекста.\n\n            Вопрос: \n            Что это?'
+
+
+class PrefixCachedHuggingFaceLLM(BaseLLM):
+    model: Any
+    tokenizer: Any
+    batch_size: int = 8
+    max_new_tokens: int = 512
+    prefix_text: str = ''
+    prefix_ids: Optional[List[int]] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return 'prefix_cached_huggingface'
+
+    def set_prefix(self, prefix_text: str):
+        # trailing whitespace merges with the next word in BPE / SentencePiece vocabularies, so it stays in the suffix
+        self.prefix_text = prefix_text.rstrip()
+        self.prefix_ids = self.tokenizer(self.prefix_text).input_ids if self.prefix_text else None
+
+        # splitting is only safe if it reproduces the ids of the full prompt, otherwise every prompt is tokenized whole
+        probe = self.prefix_text + PREFIX_PROBE
+        if self.prefix_ids is not None and self._tokenize(probe) != self.tokenizer(probe).input_ids:
+            print('Prompt prefix does not tokenize independently of the text after it, prefix caching is disabled')
+            self.prefix_ids = None
+
+    def _tokenize(self, prompt: str) -> List[int]:
+        # the fixed system prompt is tokenized once, only the rendered context and question are tokenized per call
+        if self.prefix_ids is not None and prompt.startswith(self.prefix_text):
+            suffix = prompt[len(self.prefix_text):]
+            return self.prefix_ids + self.tokenizer(suffix, add_special_tokens=False).input_ids
+        return self.tokenizer(prompt).input_ids
+
+    @property
+    def _pad_token_id(self) -> int:
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        generations = []
+
+        for start in range(0, len(prompts), self.batch_size):
+            batch = [self._tokenize(prompt) for prompt in prompts[start:start + self.batch_size]]
+            width = max(len(ids) for ids in batch)
+
+            # left padding keeps every prompt flush against its generated tokens
+            input_ids = torch.full((len(batch), width), self._pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros_like(input_ids)
+            for row, ids in enumerate(batch):
+                input_ids[row, width - len(ids):] = torch.tensor(ids)
+                attention_mask[row, width - len(ids):] = 1
+
+            with torch.inference_mode():
+                output = self.model.generate(
+                    input_ids=input_ids.to(self.model.device),
+                    attention_mask=attention_mask.to(self.model.device),
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=False,
+                    use_cache=True,
+                    pad_token_id=self._pad_token_id
+                )
+
+            for text in self.tokenizer.batch_decode(output[:, width:], skip_special_tokens=True):
+                if stop:
+                    text = enforce_stop_tokens(text, stop)
+                generations.append([Generation(text=text)])
+
+        return LLMResult(generations=generations)
@@ -0,0 +1,7 @@
+from typing import List
+from langchain_core.documents import Document
+from langchain_community.document_loaders import PyMuPDFLoader
+
+
+def load_pdf(path: str) -> List[Document]:
+    return PyMuPDFLoader(path).load()
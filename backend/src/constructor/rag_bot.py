@@ -1,9 +1,11 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-from langchain.document_loaders import PyPDFLoader, TextLoader, WebBaseLoader, BSHTMLLoader
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
+from langchain.document_loaders import TextLoader, WebBaseLoader, BSHTMLLoader
 from langchain_community.document_loaders.youtube import YoutubeLoader
 from langchain_community.document_loaders.image_captions import ImageCaptionLoader
 from langchain_community.document_loaders.csv_loader import CSVLoader
 from langchain_community.document_loaders.github import GithubFileLoader
+from langchain_community.document_loaders.web_base import default_header_template
 from langchain_community.document_loaders import (
     UnstructuredMarkdownLoader,
     JSONLoader,
@@ -11,22 +13,94 @@ from langchain_community.document_loaders import (
     UnstructuredExcelLoader,
     ConfluenceLoader,
     UnstructuredWordDocumentLoader,
+    PyMuPDFLoader,
 )
-from langchain_community.document_loaders.merge import MergedDataLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.chat_models.gigachat import GigaChat
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.chains import ConversationalRetrievalChain
 from langchain.memory import ConversationBufferMemory
-from langchain.llms import HuggingFacePipeline
 from langchain.prompts import PromptTemplate
 from typing import List, Union, Dict, Any, Optional
 from .whisper_model import WhisperModel
+from .embeddings import SentenceTransformerEmbeddings, OnnxInt8Embeddings, EmbeddingCache
+from .torch_utils import optimize_for_inference, select_device
+from .retrievers import NumbaRetriever, warmup_topk_cosine
+from .tokenizer_cache import get_tokenizer
+from .llms import PrefixCachedHuggingFaceLLM
+from datasketch import MinHash, MinHashLSH
 from .notion import fetch_and_save_notion_content
+from .pdf_loader import load_pdf
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from math import sqrt
+from uuid import uuid4
+import numpy as np
+import fake_useragent
+import requests
+import xxhash
+import faiss
+import torch
+import multiprocessing
+import threading
+import pickle
+import shutil
+import queue
 import os
 
 
+PQ_NBITS = 8
+# faiss k-means wants at least 39 training points per centroid, below this the exact flat index is kept
+IVFPQ_TRAIN_POINTS_PER_CENTROID = 39
+IVFPQ_MIN_SIZE = IVFPQ_TRAIN_POINTS_PER_CENTROID * 2 ** PQ_NBITS
+IVFPQ_TRAIN_SIZE = 64 * 1024
+STREAM_BATCH_SIZE = 128
+STREAM_QUEUE_SIZE = 256
+
+
+def _pq_subquantizers(d: int) -> int:
+    for m in (64, 48, 32, 24, 16, 8, 4, 2):
+        if d % m == 0:
+            return m
+    return 1
+
+
+class ChunkDeduplicator:
+    def __init__(self, near_duplicates: bool = False):
+        self.near_duplicates = near_duplicates
+        self.seen = set()
+        self.lsh = {}
+        self.dropped = 0
+
+    def filter(self, docs):
+        unique_docs = []
+
+        for doc in docs:
+            # duplicates are only dropped within a source, so removing one source never takes away another's content
+            source = doc.metadata.get('data_source')
+            digest = xxhash.xxh64_intdigest(doc.page_content)
+            if (source, digest) in self.seen:
+                self.dropped += 1
+                continue
+            self.seen.add((source, digest))
+
+            if self.near_duplicates:
+                if source not in self.lsh:
+                    self.lsh[source] = MinHashLSH(threshold=0.9, num_perm=64)
+                text = doc.page_content
+                minhash = MinHash(num_perm=64)
+                minhash.update_batch([text[i:i + 5].encode() for i in range(max(len(text) - 4, 1))])
+                if self.lsh[source].query(minhash):
+                    self.dropped += 1
+                    continue
+                self.lsh[source].insert(str(digest), minhash)
+
+            unique_docs.append(doc)
+
+        return unique_docs
+
+
 class EnhancedConversationBufferMemory(ConversationBufferMemory):
     def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
         if self.input_key is None:
@@ -50,17 +124,41 @@ class RAGChatBot:
         from_huggingface: bool = True,
         gigachat_api_key: Optional[str] = None,
         embeddings_model: str = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2',
+        embeddings_backend: str = 'sentence-transformers',
+        compile_embeddings: bool = False,
+        compile_llm: bool = False,
+        quantization: Optional[str] = None,
         chunk_size: int = 2000,
         chunk_overlap: int = 200,
+        dedupe_near_duplicates: bool = False,
         k_retriever: int = 5,
+        retriever_backend: str = 'faiss',
+        nprobe: int = 16,
+        index_type: str = 'ivfpq',
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        ef_search: Optional[int] = None,
+        embeddings_cache_dir: str = 'embeddings_cache',
         save_path: str = 'vector_store3.index',
         system_prompt:  Optional[str] = None
     ):
         self.data_sources = data_sources
         self.embeddings_model = embeddings_model
+        self.embeddings_backend = embeddings_backend
+        self.compile_embeddings = compile_embeddings
+        self.compile_llm = compile_llm
+        self.quantization = quantization
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.dedupe_near_duplicates = dedupe_near_duplicates
         self.k_retriever = k_retriever
+        self.retriever_backend = retriever_backend
+        self.nprobe = nprobe
+        self.index_type = index_type
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.embeddings_cache_dir = embeddings_cache_dir
         self.save_path = save_path
         self.system_prompt = system_prompt
 
@@ -91,21 +189,45 @@ class RAGChatBot:
             from_huggingface=from_huggingface,
             gigachat_api_key=gigachat_api_key
         )
+        self._update_prompt_prefix()
 
         self.embeddings = self._get_embeddings()
+        self.embedding_cache = self._get_embedding_cache()
+
+        if self.retriever_backend == 'numba':
+            warmup_topk_cosine()
 
         self.message_history = []
+        self.source_to_ids = {}
+        self.mmapped_index_path = None
         self.chat_memory = None
         self.conversation_chain = None
 
         if self.data_sources:
-            self.documents = self._load_data(self.data_sources)
-            self.docs = self._split_data(self.documents)
             self.vector_store = self._create_vector_store()
             self._initialize_conversation_chain()
 
+    def _get_retriever(self):
+        if self.retriever_backend == 'faiss':
+            return self.vector_store.as_retriever(search_kwargs={'k': self.k_retriever})
+        elif self.retriever_backend == 'numba':
+            docs = [
+                self.vector_store.docstore.search(doc_id)
+                for doc_id in self.vector_store.index_to_docstore_id.values()
+            ]
+            matrix = self._embed_with_cache([doc.page_content for doc in docs])
+            faiss.normalize_L2(matrix)
+            return NumbaRetriever(embeddings=self.embeddings, documents=docs, matrix=matrix, k=self.k_retriever)
+        else:
+            raise ValueError(f'Unsupported retriever backend: {self.retriever_backend}')
+
+    def _refresh_retriever(self):
+        # the FAISS retriever reads the live index, the numba one holds a snapshot of the vectors
+        if self.retriever_backend == 'numba' and self.conversation_chain:
+            self.conversation_chain.retriever = self._get_retriever()
+
     def _initialize_conversation_chain(self):
-        retriever = self.vector_store.as_retriever(search_kwargs={'k': self.k_retriever})
+        retriever = self._get_retriever()
 
         self.chat_memory = EnhancedConversationBufferMemory(
             memory_key='chat_history',
@@ -128,12 +250,38 @@ class RAGChatBot:
             **kwargs
         )
 
+    def _update_prompt_prefix(self):
+        if isinstance(self.llm, PrefixCachedHuggingFaceLLM):
+            self.llm.set_prefix(self.custom_prompt_template.split('{context}')[0] if self.system_prompt else '')
+
     def chat(self, query: str):
         if not self.conversation_chain:
             raise ValueError('Initialize chatbot with documents first')
         result = self.conversation_chain({'question': query})
-        answer_text = result['answer']
+        return self._extract_answer(result['answer']), result['source_documents']
 
+    async def chat_batch(self, queries: List[str]):
+        if not self.conversation_chain:
+            raise ValueError('Initialize chatbot with documents first')
+
+        # stateless: the queries are answered independently, without reading or extending the chat history
+        combine_docs_chain = self.conversation_chain.combine_docs_chain
+        source_documents = await self.conversation_chain.retriever.abatch(queries)
+        prompts = [
+            combine_docs_chain.llm_chain.prompt.format_prompt(
+                **combine_docs_chain._get_inputs(docs, question=query, chat_history='')
+            )
+            for query, docs in zip(queries, source_documents)
+        ]
+
+        # one generate call lets the LLM batch every prompt instead of running a chain per query
+        result = await self.llm.agenerate_prompt(prompts)
+        return [
+            (self._extract_answer(generations[0].text), docs)
+            for generations, docs in zip(result.generations, source_documents)
+        ]
+
+    def _extract_answer(self, answer_text: str) -> str:
         answer_text = answer_text.replace('\n', ' ')
 
         useful_answer_start = answer_text.find("Полезный ответ:")
@@ -147,13 +295,19 @@ class RAGChatBot:
         if last_period_index != -1:
             useful_answer = useful_answer[:last_period_index].strip()
 
-        return useful_answer, result['source_documents']
+        return useful_answer
 
-    def _load_data(self, sources: List[tuple]):
+    def _get_loaders(self, sources: List[tuple]):
         loaders = []
+        loader_sources = []
         whisper_model = WhisperModel()
+        session = requests.Session()
+        session.headers.update(default_header_template)
+        session.headers['User-Agent'] = fake_useragent.UserAgent().random
 
         for mode, source in sources:
+            first_loader = len(loaders)
+
             if mode == 'file':
                 if source.lower().endswith('.txt'):
                     try:
@@ -162,7 +316,7 @@ class RAGChatBot:
                         raise RuntimeError(f"Error loading .txt file '{source}': {e}")
                 elif source.lower().endswith('.pdf'):
                     try:
-                        loaders.append(PyPDFLoader(source))
+                        loaders.append(PyMuPDFLoader(source))
                     except Exception as e:
                         raise RuntimeError(f"Error loading .pdf file '{source}': {e}")
                 elif source.lower().endswith(('.doc', '.docx')):
@@ -218,7 +372,7 @@ class RAGChatBot:
             elif mode == 'url' or mode == 'urls':
                 if source.startswith(('http://', 'https://')):
                     try:
-                        loaders.append(WebBaseLoader(source))
+                        loaders.append(WebBaseLoader(source, session=session, requests_kwargs={'timeout': 10}))
                     except Exception as e:
                         #raise RuntimeError(f"Error loading URL '{source}': {e}")
                         pass
@@ -264,27 +418,136 @@ class RAGChatBot:
             else:
                 raise ValueError(f'Unsupported mode: {mode}')
 
-        merged_loader = MergedDataLoader(loaders=loaders)
-        return merged_loader.load()
+            loader_sources.extend([(mode, source)] * (len(loaders) - first_loader))
 
-    def _split_data(self, documents):
-        text_splitter = RecursiveCharacterTextSplitter(
+        return loaders, loader_sources
+
+    def _iter_documents(self, sources: List[tuple]):
+        loaders, loader_sources = self._get_loaders(sources)
+        if not loaders:
+            return
+
+        pdf_paths = [loader.file_path for loader in loaders if isinstance(loader, PyMuPDFLoader)]
+        process_pool = None
+        if len(pdf_paths) > 1:
+            # PDF parsing is CPU-bound, so several PDFs are parsed in separate processes
+            process_pool = ProcessPoolExecutor(
+                max_workers=min(os.cpu_count() or 1, len(pdf_paths)),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+        try:
+            # the remaining loaders are dominated by disk and network I/O, which releases the GIL
+            with ThreadPoolExecutor(max_workers=min(16, len(loaders))) as executor:
+                futures = {
+                    (
+                        process_pool.submit(load_pdf, loader.file_path)
+                        if process_pool and isinstance(loader, PyMuPDFLoader)
+                        else executor.submit(loader.load)
+                    ): source
+                    for source, loader in zip(loader_sources, loaders)
+                }
+                # documents are handed on as soon as each loader finishes, slow URLs do not hold back fast files
+                for future in as_completed(futures):
+                    docs = future.result()
+                    for doc in docs:
+                        doc.metadata['data_source'] = futures[future]
+                    yield docs
+        finally:
+            if process_pool:
+                process_pool.shutdown()
+
+    def _load_data(self, sources: List[tuple]):
+        return [doc for docs in self._iter_documents(sources) for doc in docs]
+
+    def _get_text_splitter(self):
+        return RecursiveCharacterTextSplitter(
             chunk_size=self.chunk_size,
             chunk_overlap=self.chunk_overlap,
         )
-        return text_splitter.split_documents(documents)
+
+    def _split_data(self, documents):
+        deduplicator = ChunkDeduplicator(self.dedupe_near_duplicates)
+        docs = deduplicator.filter(self._get_text_splitter().split_documents(documents))
+        if deduplicator.dropped:
+            print(f'Dropped {deduplicator.dropped} duplicate chunks.')
+        return docs
 
     def _get_embeddings(self, retriever: str = None):
-        return HuggingFaceEmbeddings(model_name=retriever or self.embeddings_model)
+        if self.embeddings_backend == 'sentence-transformers':
+            return SentenceTransformerEmbeddings(
+                model_name=retriever or self.embeddings_model,
+                max_seq_length=self.chunk_size,
+                compile_model=self.compile_embeddings
+            )
+        elif self.embeddings_backend == 'onnx-int8':
+            return OnnxInt8Embeddings(
+                model_name=retriever or self.embeddings_model,
+                max_seq_length=self.chunk_size
+            )
+        else:
+            raise ValueError(f'Unsupported embeddings backend: {self.embeddings_backend}')
+
+    def _get_embedding_cache(self):
+        return EmbeddingCache(os.path.join(
+            self.embeddings_cache_dir,
+            self.embeddings_backend,
+            self.embeddings.model_name.replace('/', '__')
+        ))
+
+    def _embed_with_cache(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        keys = [xxhash.xxh64_hexdigest(text.encode()) for text in texts]
+        vectors = self.embedding_cache.get(keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            new_vectors = self.embeddings.encode(list(missing.values()))
+            self.embedding_cache.put(list(missing), new_vectors)
+            vectors.update(zip(missing, new_vectors))
+
+        embeddings = np.empty((len(keys), len(vectors[keys[0]])), dtype=np.float32)
+        for i, key in enumerate(keys):
+            embeddings[i] = vectors[key]
+        return embeddings
 
     def _get_model(self, model_name: str = None, from_huggingface: bool = True, gigachat_api_key: str = None):
         if from_huggingface:
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            pipe = pipeline(
-                'text-generation', model=model, tokenizer=tokenizer, max_new_tokens=512
+            # shared with the embedder and other bots, so it is left unmodified (padding is done by the LLM wrapper)
+            tokenizer = get_tokenizer(model_name)
+
+            if self.quantization not in (None, '4bit'):
+                raise ValueError(f'Unsupported quantization: {self.quantization}')
+
+            # bitsandbytes kernels are CUDA-only, so 4-bit is skipped on CPU hosts
+            quantization_config = None
+            if self.quantization == '4bit' and select_device() == 'cuda':
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                    bnb_4bit_quant_type='nf4',
+                    bnb_4bit_use_double_quant=True
+                )
+            elif self.quantization == '4bit':
+                print('4-bit quantization requires CUDA, loading the model unquantized')
+
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.bfloat16 if select_device() == 'cuda' else torch.float32,
+                attn_implementation='flash_attention_2' if is_flash_attn_2_available() else 'sdpa',
+                quantization_config=quantization_config,
+                device_map='auto'
+            )
+            if self.compile_llm:
+                model = optimize_for_inference(model, model.device.type)
+            llm = PrefixCachedHuggingFaceLLM(
+                model=model,
+                tokenizer=tokenizer,
+                batch_size=8,
+                max_new_tokens=512
             )
-            llm = HuggingFacePipeline(pipeline=pipe)
         else:
             llm = GigaChat(
                 credentials="NGRhNTM4ZWYtZjJmMy00Y2JjLWE1MjItMTkwMjYxNDU4MjMyOjY5YWJiNTc4LWE0YTctNDE1OC1iYTgwLWZiMzAxYjQxZDc3Mg==",
@@ -294,39 +557,343 @@ class RAGChatBot:
 
         return llm
 
+    def _build_index(self, embeddings: np.ndarray):
+        n, d = embeddings.shape
+
+        if self.index_type not in ('flat', 'flat_fp16', 'hnsw', 'ivfpq'):
+            raise ValueError(f'Unsupported index type: {self.index_type}')
+        if self.index_type == 'hnsw':
+            return self._new_hnsw_index(d)
+        if self.index_type == 'flat_fp16':
+            return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        if self.index_type == 'flat' or n < IVFPQ_MIN_SIZE:
+            return faiss.IndexFlatL2(d)
+
+        # the codebooks are trained once on a bounded uniform sample and reused by every later add
+        sample = np.random.default_rng(0).choice(n, min(n, IVFPQ_TRAIN_SIZE), replace=False)
+
+        # capped so the coarse quantizer is not under-trained either
+        nlist = min(4 * int(sqrt(n)), len(sample) // IVFPQ_TRAIN_POINTS_PER_CENTROID)
+        quantizer = faiss.IndexFlatL2(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, _pq_subquantizers(d), PQ_NBITS)
+        index.train(np.ascontiguousarray(embeddings[np.sort(sample)], dtype=np.float32))
+        return index
+
+    def _new_hnsw_index(self, d: int):
+        index = faiss.IndexHNSWFlat(d, self.hnsw_m)
+        index.hnsw.efConstruction = self.ef_construction
+        return index
+
+    def _maybe_train_ivfpq(self):
+        index = self.vector_store.index
+        if self.index_type != 'ivfpq' or not isinstance(index, faiss.IndexFlat) or index.ntotal < IVFPQ_MIN_SIZE:
+            return
+
+        print(f'Vector store reached {index.ntotal} vectors, training IVF-PQ index')
+        vectors = index.reconstruct_n(0, index.ntotal)
+        ivf_index = self._build_index(vectors)
+        ivf_index.add_with_ids(vectors, np.arange(index.ntotal, dtype=np.int64))
+        self.vector_store.index = ivf_index
+        self._configure_index(self.vector_store)
+
+    def _configure_index(self, vector_store):
+        if isinstance(vector_store.index, faiss.IndexIVF):
+            vector_store.index.nprobe = self.nprobe
+        if isinstance(vector_store.index, faiss.IndexHNSW):
+            vector_store.index.hnsw.efSearch = self.ef_search or max(32, 4 * self.k_retriever)
+        if vector_store.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            # cosine similarity: stored vectors are normalized on add, queries are normalized by FAISS
+            vector_store.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+            vector_store._normalize_L2 = True
+        return vector_store
+
+    def _prepare_vectors(self, index, embeddings: np.ndarray) -> np.ndarray:
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def _build_vector_store(self, docs):
+        embeddings = self._embed_with_cache([doc.page_content for doc in docs])
+        index = self._build_index(embeddings)
+        index.add(self._prepare_vectors(index, embeddings))
+        return self._wrap_vector_store(index, docs)
+
+    def _stream_vector_store(self, sources: List[tuple]):
+        chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        deduplicator = ChunkDeduplicator(self.dedupe_near_duplicates)
+        stop = threading.Event()
+        errors = []
+
+        def produce():
+            loaded = self._iter_documents(sources)
+            try:
+                text_splitter = self._get_text_splitter()
+                for documents in loaded:
+                    for chunk in deduplicator.filter(text_splitter.split_documents(documents)):
+                        if stop.is_set():
+                            return
+                        chunks.put(chunk)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # closing the generator runs its finally, which shuts down the loader pools
+                loaded.close()
+                if not stop.is_set():
+                    chunks.put(None)
+
+        # loading and splitting run ahead in a producer thread while this thread embeds and indexes
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        docs = []
+        batch = []
+        pending = []
+        index = None
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is not None:
+                    batch.append(chunk)
+                if batch and (chunk is None or len(batch) == STREAM_BATCH_SIZE):
+                    vectors = self._embed_with_cache([doc.page_content for doc in batch])
+                    docs.extend(batch)
+                    batch = []
+
+                    # IVF-PQ needs the whole corpus to size and train its codebooks, other indexes grow per batch
+                    if self.index_type == 'ivfpq':
+                        pending.append(vectors)
+                    else:
+                        if index is None:
+                            index = self._build_index(vectors)
+                        index.add(self._prepare_vectors(index, vectors))
+                if chunk is None:
+                    break
+        finally:
+            # if embedding fails, keep draining so the producer is never stuck on a full queue
+            stop.set()
+            while producer.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        producer.join()
+        if errors:
+            raise errors[0]
+        if not docs:
+            raise ValueError('No documents were loaded from the data sources')
+        if deduplicator.dropped:
+            print(f'Dropped {deduplicator.dropped} duplicate chunks.')
+
+        if pending:
+            vectors = np.concatenate(pending)
+            index = self._build_index(vectors)
+            index.add(self._prepare_vectors(index, vectors))
+        return self._wrap_vector_store(index, docs)
+
+    def _wrap_vector_store(self, index, docs):
+        ids = [str(uuid4()) for _ in docs]
+        vector_store = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(dict(zip(ids, docs))),
+            index_to_docstore_id=dict(enumerate(ids)),
+        )
+        self.mmapped_index_path = None
+        return self._configure_index(vector_store)
+
+    def _load_faiss_mmap(self, path: str):
+        index_path = os.path.join(path, 'index.faiss')
+        # faiss only maps IVF inverted lists, whose pages are faulted in lazily on search;
+        # flat, fp16 and HNSW indexes are still read fully into RAM and stay writable
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+        with open(os.path.join(path, 'docstore.pkl'), 'rb') as f:
+            docstore = pickle.load(f)
+        with open(os.path.join(path, 'index_to_docstore_id.pkl'), 'rb') as f:
+            index_to_docstore_id = pickle.load(f)
+
+        self.mmapped_index_path = index_path if isinstance(index, faiss.IndexIVF) else None
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+
+    def _load_vector_store(self, path: str):
+        current_path = os.path.join(path, 'CURRENT')
+        if os.path.exists(current_path):
+            with open(current_path) as f:
+                path = os.path.join(path, f.read().strip())
+
+        if os.path.exists(os.path.join(path, 'docstore.pkl')):
+            vector_store = self._load_faiss_mmap(path)
+        else:
+            vector_store = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+            self.mmapped_index_path = None
+        return self._configure_index(vector_store)
+
+    def _ensure_writable_index(self):
+        if self.mmapped_index_path:
+            self.vector_store.index = faiss.read_index(self.mmapped_index_path)
+            self._configure_index(self.vector_store)
+            self.mmapped_index_path = None
+
+    def _save_vector_store(self, vector_store):
+        # a read-only mmapped IVF index is written as a stub pointing at the file it would then replace
+        self._ensure_writable_index()
+        os.makedirs(self.save_path, exist_ok=True)
+
+        # all three files go into a fresh version directory that is published by atomically replacing CURRENT,
+        # so an interrupted save leaves the previous version in place rather than a mix of old and new files
+        version = f'v-{uuid4().hex}'
+        version_path = os.path.join(self.save_path, version)
+        os.makedirs(version_path)
+        faiss.write_index(vector_store.index, os.path.join(version_path, 'index.faiss'))
+        for name, obj in (
+            ('docstore.pkl', vector_store.docstore),
+            ('index_to_docstore_id.pkl', vector_store.index_to_docstore_id),
+        ):
+            with open(os.path.join(version_path, name), 'wb') as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        current_path = os.path.join(self.save_path, 'CURRENT')
+        with open(current_path + '.tmp', 'w') as f:
+            f.write(version)
+        os.replace(current_path + '.tmp', current_path)
+
+        # older versions, unpublished leftovers of interrupted saves and files of the flat layout are now unused
+        for name in os.listdir(self.save_path):
+            path = os.path.join(self.save_path, name)
+            if name.startswith('v-') and name != version:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name in ('index.faiss', 'index.pkl', 'docstore.pkl', 'index_to_docstore_id.pkl'):
+                os.remove(path)
+
     def _create_vector_store(self):
         if os.path.exists(self.save_path):
             print(f'Loading existing vector store from {self.save_path}')
-            vector_store = FAISS.load_local(self.save_path, self.embeddings, allow_dangerous_deserialization=True)
+            vector_store = self._load_vector_store(self.save_path)
         else:
             print(f'Creating new vector store and saving to {self.save_path}')
-            vector_store = FAISS.from_documents(
-                documents=self.docs,
-                embedding=self.embeddings
-            )
-            vector_store.save_local(self.save_path)
+            vector_store = self._stream_vector_store(self.data_sources)
+            self._save_vector_store(vector_store)
+        self.source_to_ids = self._map_sources_to_ids(vector_store)
         return vector_store
 
+    def _map_sources_to_ids(self, vector_store) -> Dict[tuple, List[str]]:
+        source_to_ids = {}
+        for doc_id in vector_store.index_to_docstore_id.values():
+            source = vector_store.docstore.search(doc_id).metadata.get('data_source')
+            if source is not None:
+                source_to_ids.setdefault(tuple(source), []).append(doc_id)
+        return source_to_ids
+
+    def _add_documents(self, docs) -> List[str]:
+        if not docs:
+            return []
+
+        self._ensure_writable_index()
+
+        embeddings = self._prepare_vectors(
+            self.vector_store.index,
+            self._embed_with_cache([doc.page_content for doc in docs])
+        )
+        ids = [str(uuid4()) for _ in docs]
+
+        # IVF labels are not compacted on removal, so new vectors get labels above the current maximum
+        start = max(self.vector_store.index_to_docstore_id, default=-1) + 1
+        labels = np.arange(start, start + len(docs), dtype=np.int64)
+
+        if isinstance(self.vector_store.index, faiss.IndexIVF):
+            self.vector_store.index.add_with_ids(embeddings, labels)
+        else:
+            self.vector_store.index.add(embeddings)
+
+        self.vector_store.docstore.add(dict(zip(ids, docs)))
+        self.vector_store.index_to_docstore_id.update(zip(labels.tolist(), ids))
+        self._maybe_train_ivfpq()
+        return ids
+
+    def _delete_documents(self, ids: List[str]):
+        self._ensure_writable_index()
+        if isinstance(self.vector_store.index, faiss.IndexHNSW):
+            self._rebuild_hnsw_without(set(ids))
+            return
+        if not isinstance(self.vector_store.index, faiss.IndexIVF):
+            self.vector_store.delete(ids=ids)
+            return
+
+        ids = set(ids)
+        labels = [label for label, doc_id in self.vector_store.index_to_docstore_id.items() if doc_id in ids]
+        self.vector_store.index.remove_ids(np.array(labels, dtype=np.int64))
+
+        for label in labels:
+            del self.vector_store.index_to_docstore_id[label]
+        self.vector_store.docstore.delete(list(ids))
+
+    def _rebuild_hnsw_without(self, ids: set):
+        # HNSW graphs cannot drop nodes, so the remaining vectors are re-inserted into a fresh graph
+        index = self.vector_store.index
+        remaining = [
+            (label, doc_id)
+            for label, doc_id in sorted(self.vector_store.index_to_docstore_id.items())
+            if doc_id not in ids
+        ]
+
+        new_index = self._new_hnsw_index(index.d)
+        if remaining:
+            new_index.add(index.reconstruct_batch(np.array([label for label, _ in remaining], dtype=np.int64)))
+
+        self.vector_store.index = new_index
+        self.vector_store.index_to_docstore_id = {i: doc_id for i, (_, doc_id) in enumerate(remaining)}
+        self.vector_store.docstore.delete(list(ids))
+        self._configure_index(self.vector_store)
+
     def add_sources(self, new_sources: List[tuple]):
         new_documents = self._load_data(new_sources)
         new_docs = self._split_data(new_documents)
 
-        self.vector_store.add_documents(new_docs)
-        self.vector_store.save_local(self.save_path)
+        ids = self._add_documents(new_docs)
+        if ids:
+            self._save_vector_store(self.vector_store)
+            self._refresh_retriever()
+
+        for doc, doc_id in zip(new_docs, ids):
+            self.source_to_ids.setdefault(doc.metadata['data_source'], []).append(doc_id)
 
         self.data_sources.extend(new_sources)
         print(f'Successfully added {len(new_sources)} new sources to the chatbot.')
 
     def remove_sources(self, sources_to_remove: List[tuple]):
-        self.data_sources = [
+        remaining_sources = [
             source for source in self.data_sources if source not in sources_to_remove
         ]
 
-        self.documents = self._load_data(self.data_sources)
-        self.docs = self._split_data(self.documents)
+        # stores saved before chunks were tagged with their source cannot be pruned by id, so they are rebuilt;
+        # in a tagged store a source without ids has no chunks to remove
+        if not self.source_to_ids and sources_to_remove:
+            print('Vector store has no source metadata, rebuilding it from the remaining sources')
+            self.vector_store = self._stream_vector_store(remaining_sources)
+            self._save_vector_store(self.vector_store)
+            self.source_to_ids = self._map_sources_to_ids(self.vector_store)
+            if self.conversation_chain:
+                self.conversation_chain.retriever = self._get_retriever()
+            self.data_sources = remaining_sources
+            print(f'Successfully removed {len(sources_to_remove)} new sources from the chatbot.')
+            return
 
-        self.vector_store = FAISS.from_documents(self.docs, self.embeddings)
-        self.vector_store.save_local(self.save_path)
+        ids = [
+            doc_id
+            for source in sources_to_remove
+            for doc_id in self.source_to_ids.pop(tuple(source), [])
+        ]
+        if ids:
+            self._delete_documents(ids)
+            self._save_vector_store(self.vector_store)
+            self._refresh_retriever()
+        self.data_sources = remaining_sources
         print(f'Successfully removed {len(sources_to_remove)} new sources from the chatbot.')
 
     def change_model(self, new_model_name: str, from_huggingface: bool = True, gigachat_api_key: Optional[str] = None):
@@ -335,13 +902,29 @@ class RAGChatBot:
             from_huggingface=from_huggingface,
             gigachat_api_key=gigachat_api_key
         )
-        self._initialize_conversation_chain()
+        self._update_prompt_prefix()
+
+        # patch the running chain so the chat history survives the swap
+        if self.conversation_chain:
+            self.conversation_chain.combine_docs_chain.llm_chain.llm = self.llm
+            self.conversation_chain.question_generator.llm = self.llm
         print(f'Model successfully changed to {new_model_name}.')
 
     def change_retriever(self, new_embeddings_model: str):
+        self.embeddings_model = new_embeddings_model
         self.embeddings = self._get_embeddings(retriever=new_embeddings_model)
-        self.vector_store = self._create_vector_store()
-        self._initialize_conversation_chain()
+        self.embedding_cache = self._get_embedding_cache()
+
+        if self.conversation_chain:
+            # stored vectors belong to the old model, so the same chunks are re-embedded with the new one
+            docs = [
+                self.vector_store.docstore.search(doc_id)
+                for doc_id in self.vector_store.index_to_docstore_id.values()
+            ]
+            self.vector_store = self._build_vector_store(docs)
+            self._save_vector_store(self.vector_store)
+            self.source_to_ids = self._map_sources_to_ids(self.vector_store)
+            self.conversation_chain.retriever = self._get_retriever()
         print(f'Retriever successfully changed to {new_embeddings_model}.')
 
     def change_prompt(self, new_system_prompt: str):
@@ -366,8 +949,10 @@ class RAGChatBot:
             template=self.custom_prompt_template,
             input_variables=['context', 'question', 'chat_history'],
         )
+        self._update_prompt_prefix()
 
-        self._initialize_conversation_chain()
+        if self.conversation_chain:
+            self.conversation_chain.combine_docs_chain.llm_chain.prompt = self.custom_prompt
         print(f'System prompt successfully changed to: {new_system_prompt}')
 
     def change_index(self, index_path: str):
@@ -375,9 +960,13 @@ class RAGChatBot:
             raise FileNotFoundError(f"The specified index file '{index_path}' does not exist.")
 
         try:
-            self.vector_store = FAISS.load_local(index_path, self.embeddings, allow_dangerous_deserialization=True)
+            self.vector_store = self._load_vector_store(index_path)
+            self.source_to_ids = self._map_sources_to_ids(self.vector_store)
             self.save_path = index_path
-            self._initialize_conversation_chain()
+            if self.conversation_chain:
+                self.conversation_chain.retriever = self._get_retriever()
+            else:
+                self._initialize_conversation_chain()
             print(f"Index successfully changed to '{index_path}' and reloaded.")
         except Exception as e:
             raise RuntimeError(f"Failed to load the new index from '{index_path}': {e}")
@@ -0,0 +1,46 @@
+from typing import Any, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from numba import njit, prange
+import numpy as np
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _cosine_scores(query_vec: np.ndarray, mat: np.ndarray) -> np.ndarray:
+    n, d = mat.shape
+    scores = np.empty(n, dtype=np.float32)
+    for i in prange(n):
+        acc = 0.0
+        for j in range(d):
+            acc += mat[i, j] * query_vec[j]
+        scores[i] = acc
+    return scores
+
+
+def _topk_cosine(query_vec: np.ndarray, mat: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, mat.shape[0])
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+
+    scores = _cosine_scores(query_vec, mat)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def warmup_topk_cosine():
+    _topk_cosine(np.ones(8, dtype=np.float32), np.ones((2, 8), dtype=np.float32), 1)
+
+
+class NumbaRetriever(BaseRetriever):
+    embeddings: Any
+    documents: List[Document]
+    matrix: Any
+    k: int = 5
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vec = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        query_vec /= max(np.linalg.norm(query_vec), 1e-12)
+        return [self.documents[i] for i in _topk_cosine(query_vec, self.matrix, self.k)]
@@ -0,0 +1,35 @@
+from typing import Dict
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+import xxhash
+
+_TOKENIZER_CACHE: Dict[str, PreTrainedTokenizerBase] = {}
+_SHARED_TOKENIZERS: Dict[str, PreTrainedTokenizerBase] = {}
+
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    # the serialized backend covers vocab, normalizer, pre-tokenizer and post-processor,
+    # the rest are settings kept on the Python side
+    settings = (
+        sorted(tokenizer.special_tokens_map.items()),
+        tokenizer.model_max_length,
+        tokenizer.padding_side,
+        tokenizer.truncation_side,
+    )
+    return xxhash.xxh64_hexdigest(tokenizer.backend_tokenizer.to_str() + repr(settings))
+
+
+def share_tokenizer(tokenizer: PreTrainedTokenizerBase) -> PreTrainedTokenizerBase:
+    # slow tokenizers have no serialized form to compare, so they are never shared
+    if not tokenizer.is_fast:
+        return tokenizer
+    # models built on the same base often ship identical tokenizers, so they can all use one instance
+    return _SHARED_TOKENIZERS.setdefault(tokenizer_fingerprint(tokenizer), tokenizer)
+
+
+def get_tokenizer(model_name: str) -> PreTrainedTokenizerBase:
+    if model_name not in _TOKENIZER_CACHE:
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        if not tokenizer.is_fast:
+            print(f'No fast tokenizer available for {model_name}, falling back to the Python implementation')
+        _TOKENIZER_CACHE[model_name] = share_tokenizer(tokenizer)
+    return _TOKENIZER_CACHE[model_name]
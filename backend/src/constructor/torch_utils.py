@@ -0,0 +1,23 @@
+from typing import Optional
+import torch
+
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError:
+    ipex = None
+
+
+def select_device() -> str:
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def optimize_for_inference(model: torch.nn.Module, device: str, dtype: Optional[torch.dtype] = None):
+    model = model.eval()
+
+    if device == 'cpu' and ipex is not None:
+        model = ipex.optimize(model, dtype=dtype)
+
+    # dynamic=True keeps a single graph for every batch size / sequence length instead of recompiling per shape;
+    # CUDA graphs ('reduce-overhead') would still be re-recorded per shape, so the default mode is used
+    model.forward = torch.compile(model.forward, mode='default', dynamic=True, fullgraph=False)
+    return model